@@ -1,21 +1,56 @@
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from models import init_db, async_session, VPNKey, TypesVPN, CountriesVPN, ServersVPN
 from sqlalchemy import select, update
 import requestsfile as rq
 from datetime import datetime, timedelta
 from typing import List
+import asyncio
 import uuid
-from bot import create_stars_invoice
+from bot import create_stars_invoice, BOT_TOKEN
+
+EXPIRE_CHECK_INTERVAL = 600  # секунд между проверками истёкших ключей
+ARCHIVE_INTERVAL = 24 * 3600  # секунд между запусками архивации
+
+
+# фоновая проверка истёкших ключей
+async def expire_keys_loop():
+    while True:
+        try:
+            await rq.expire_vpn_keys()
+        except Exception as e:
+            print(f"expire_vpn_keys failed: {e}")
+        await asyncio.sleep(EXPIRE_CHECK_INTERVAL)
+
+
+# фоновая архивация давно истёкших ключей
+async def archive_loop():
+    while True:
+        try:
+            result = await rq.archive_expired_keys()
+            print(f"archive: moved {result['keys']} keys, {result['subscriptions']} subscriptions")
+        except Exception as e:
+            print(f"archive_expired_keys failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
 
 # --- FastAPI приложение ---
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
+    if not rq.SUBSCRIPTION_SECRET:
+        raise RuntimeError("SUBSCRIPTION_SECRET не задан: ссылки подписки не будут переживать перезапуск")
     await init_db()
+    await rq.ensure_user_vpn_views()
+    await rq.ensure_stats()
+    expire_task = asyncio.create_task(expire_keys_loop())
+    archive_task = asyncio.create_task(archive_loop())
     print("VPN backend ready!")
     yield
+    expire_task.cancel()
+    archive_task.cancel()
 
 app = FastAPI(title="ArtCry VPN", lifespan=lifespan)
 
@@ -42,6 +77,42 @@ async def my_vpns(tg_id: int):
     return await rq.get_my_vpns(tg_id)
 
 
+# ======================
+# SUBSCRIPTION URL
+# ======================
+
+class SubscriptionURLRequest(BaseModel):
+    init_data: str  # Telegram.WebApp.initData
+
+
+# ссылка выдаётся только владельцу, подтверждённому подписью Telegram
+@app.post("/api/vpn/sub-url")
+async def subscription_url(data: SubscriptionURLRequest, request: Request):
+    tg_id = rq.check_webapp_init_data(data.init_data, BOT_TOKEN)
+    if tg_id is None:
+        raise HTTPException(401, "Invalid initData")
+
+    sig = rq.sign_subscription(tg_id)
+    return {"url": str(request.url_for("subscription", tg_id=tg_id, sig=sig))}
+
+
+@app.get("/api/vpn/sub/{tg_id}/{sig}", name="subscription")
+async def subscription(tg_id: int, sig: str, request: Request, format: str = "base64"):
+    if not rq.check_subscription_signature(tg_id, sig):
+        raise HTTPException(404, "Subscription not found")
+    if format not in ("base64", "plain"):
+        raise HTTPException(400, "format must be base64 or plain")
+
+    doc = await rq.get_subscription(tg_id)
+    # ETag зависит от формата, чтобы клиенты не путали кэши
+    etag = doc["etag"][:-1] + f'-{format}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=doc[format], media_type="text/plain; charset=utf-8", headers=headers)
+
+
 # ======================
 # BUY VPN
 # ======================
@@ -88,7 +159,7 @@ class RenewVPN(BaseModel):
 @app.post("/api/vpn/renew-invoice")
 async def renew_invoice(data: RenewVPN):
     payload = f"renew:{data.tg_id}:{data.vpn_key_id}:{data.months}:{uuid.uuid4()}"
-    stars = data.months * 50
+    stars = data.months * rq.RENEW_STARS_PER_MONTH
 
     invoice_url = await create_stars_invoice(
         title="Продление VPN",
@@ -102,7 +173,10 @@ async def renew_invoice(data: RenewVPN):
 
 @app.post("/api/vpn/renew-success")
 async def renew_success(payload: str):
-    await rq.renew_vpn_from_payload(payload)
+    try:
+        await rq.renew_vpn_from_payload(payload)
+    except ValueError as ve:
+        raise HTTPException(status_code=404, detail=str(ve))
     return {"status": "ok"}
 
 
@@ -216,6 +290,13 @@ async def admin_add_server(server: ServerCreate):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/admin/servers/bulk")
+async def admin_bulk_upsert_servers(servers: List[ServerCreate]):
+    try:
+        return await rq.admin_bulk_upsert_servers(servers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.patch("/api/admin/servers/{server_id}")
 async def admin_update_server(server_id: int, server: ServerUpdate):
     try:
@@ -232,6 +313,103 @@ async def admin_delete_server(server_id: int):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# =======================
+# --- MAINTENANCE ADMIN ---
+# =======================
+@app.post("/api/admin/rebuild-vpn-views")
+async def admin_rebuild_vpn_views():
+    try:
+        return await rq.rebuild_user_vpn_views()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/user-cache-stats")
+async def admin_user_cache_stats():
+    return rq.get_user_cache_stats()
+
+@app.get("/api/admin/subscription-cache-stats")
+async def admin_subscription_cache_stats():
+    return rq.get_subscription_cache_stats()
+
+# =======================
+# --- ARCHIVE ADMIN ---
+# =======================
+@app.post("/api/admin/archive/run")
+async def admin_run_archive(retention_days: int = rq.ARCHIVE_RETENTION_DAYS):
+    if retention_days < 1:
+        raise HTTPException(status_code=400, detail="retention_days должен быть не меньше 1")
+    try:
+        return await rq.archive_expired_keys(retention_days)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/archive/keys")
+async def admin_archived_keys(tg_id: int | None = None, limit: int = 100, offset: int = 0):
+    try:
+        return await rq.admin_get_archived_keys(tg_id, limit, offset)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/archive/subscriptions")
+async def admin_archived_subscriptions(tg_id: int | None = None, limit: int = 100, offset: int = 0):
+    try:
+        return await rq.admin_get_archived_subscriptions(tg_id, limit, offset)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# =======================
+# --- STATS ADMIN ---
+# =======================
+@app.get("/api/admin/stats")
+async def admin_stats(days: int = 30):
+    try:
+        return await rq.get_stats(days)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/stats/check")
+async def admin_check_stats(fix: bool = False):
+    try:
+        return await rq.check_stats(fix)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# =======================
+# --- EXPORTS ADMIN ---
+# =======================
+# date_from включительно, date_to не включительно (по created_at)
+def export_response(name: str, fmt: str, chunks):
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        chunks,
+        media_type=f"{media_type}; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    )
+
+def check_export_format(fmt: str):
+    if fmt not in rq.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+
+@app.get("/api/admin/export/keys")
+async def admin_export_keys(format: str = "csv", date_from: datetime | None = None, date_to: datetime | None = None):
+    check_export_format(format)
+    return export_response("keys", format, rq.export_keys(format, date_from, date_to))
+
+@app.get("/api/admin/export/users")
+async def admin_export_users(format: str = "csv", date_from: datetime | None = None, date_to: datetime | None = None):
+    check_export_format(format)
+    return export_response("users", format, rq.export_users(format, date_from, date_to))
+
+@app.get("/api/admin/export/servers")
+async def admin_export_servers(format: str = "csv"):
+    check_export_format(format)
+    return export_response("servers", format, rq.export_servers(format))
+
+@app.get("/api/admin/export/referral-earnings")
+async def admin_export_referral_earnings(format: str = "csv", date_from: datetime | None = None, date_to: datetime | None = None):
+    check_export_format(format)
+    return export_response("referral_earnings", format, rq.export_referral_earnings(format, date_from, date_to))
+
 
 
 
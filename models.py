@@ -1,13 +1,20 @@
-from sqlalchemy import ForeignKey, String, BigInteger, Integer, Boolean, DateTime
+from sqlalchemy import event, ForeignKey, String, BigInteger, Integer, Boolean, DateTime, Date, Text
 from sqlalchemy.orm import Mapped, DeclarativeBase, mapped_column
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
-from datetime import datetime
+from datetime import datetime, date
 
 
 engine = create_async_engine(url='sqlite+aiosqlite:///db.sqlite3', echo = True)
 
 async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
 
+# WAL: долгие чтения (стриминговые выгрузки) не блокируют запись
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
@@ -96,7 +103,78 @@ class ReferralEarning(Base):
     referred_id: Mapped[int] = mapped_column(ForeignKey("users.idUser", ondelete="CASCADE"))
     amount: Mapped[int] = mapped_column(Integer)  # копейки / центы
     created_at: Mapped[datetime] = mapped_column(DateTime,default=datetime.utcnow)
-    
+
+# READ MODEL: готовый список ключей пользователя для /api/vpn/my
+class UserVPNView(Base):
+    """
+    Денормализованная витрина: обновляется при активации, продлении,
+    истечении ключей и переименовании сервера
+    """
+    __tablename__ = "user_vpn_views"
+    tg_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    idUser: Mapped[int] = mapped_column(ForeignKey("users.idUser", ondelete="CASCADE"))
+    keys_json: Mapped[str] = mapped_column(Text, default="[]")
+    # JSON-список ключей в формате ответа /api/vpn/my
+    updated_at: Mapped[datetime] = mapped_column(DateTime,default=datetime.utcnow)
+
+# ARCHIVE: истёкшие ключи и подписки старше срока хранения
+class VPNKeyArchive(Base):
+    """
+    Копия vpn_keys без внешних ключей, заполняется задачей архивации.
+    id в vpn_keys может быть выдан повторно, поэтому у архива свой первичный ключ
+    """
+    __tablename__ = "vpn_keys_archive"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    vpn_key_id: Mapped[int] = mapped_column(Integer, index=True)
+    idUser: Mapped[int] = mapped_column(Integer, index=True)
+    idServerVPN: Mapped[int] = mapped_column(Integer)
+    provider: Mapped[str] = mapped_column(String(200))
+    provider_key_id: Mapped[str] = mapped_column(String(200))
+    access_data: Mapped[str] = mapped_column(String(500))
+    created_at: Mapped[datetime] = mapped_column(DateTime)
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+    is_active: Mapped[bool] = mapped_column(Boolean)
+    archived_at: Mapped[datetime] = mapped_column(DateTime,default=datetime.utcnow)
+
+
+class VPNSubscriptionArchive(Base):
+    __tablename__ = "vpn_subscriptions_archive"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    subscription_id: Mapped[int] = mapped_column(Integer, index=True)
+    idUser: Mapped[int] = mapped_column(Integer, index=True)
+    vpn_key_id: Mapped[int] = mapped_column(Integer, index=True)
+    started_at: Mapped[datetime] = mapped_column(DateTime)
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+    status: Mapped[str] = mapped_column(String(50))
+    archived_at: Mapped[datetime] = mapped_column(DateTime,default=datetime.utcnow)
+
+# STATS: счётчики для админского дашборда, обновляются в тех же транзакциях,
+# что и ключи/пользователи
+class StatsServer(Base):
+    __tablename__ = "stats_servers"
+    idServerVPN: Mapped[int] = mapped_column(Integer, primary_key=True)
+    active_keys: Mapped[int] = mapped_column(Integer, default=0)
+    activations: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(Integer, default=0)  # в звёздах
+
+
+class StatsCountry(Base):
+    __tablename__ = "stats_countries"
+    idCountry: Mapped[int] = mapped_column(Integer, primary_key=True)
+    active_keys: Mapped[int] = mapped_column(Integer, default=0)
+    activations: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class StatsDaily(Base):
+    __tablename__ = "stats_daily"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    signups: Mapped[int] = mapped_column(Integer, default=0)
+    activations: Mapped[int] = mapped_column(Integer, default=0)
+    renewals: Mapped[int] = mapped_column(Integer, default=0)
+    expirations: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(Integer, default=0)
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
@@ -1,8 +1,441 @@
-from sqlalchemy import select, update, delete
-from models import async_session, User, VPNKey, VPNSubscription, TypesVPN, CountriesVPN, ServersVPN
+from sqlalchemy import select, update, delete, insert, literal, func, union_all, false
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import (async_session, User, VPNKey, VPNSubscription, TypesVPN, CountriesVPN, ServersVPN, UserVPNView,
+                    VPNKeyArchive, VPNSubscriptionArchive, ReferralEarning, StatsServer, StatsCountry, StatsDaily)
 from outline_api import OutlineAPI
-from typing import List
-from datetime import datetime, timedelta
+from typing import List, AsyncIterator
+from datetime import datetime, timedelta, date
+from collections import OrderedDict
+import aiohttp
+import asyncio
+import base64
+import csv
+import io
+import hashlib
+import hmac
+import json
+import os
+import time
+from urllib.parse import parse_qsl
+
+
+# =======================
+# --- READ MODEL /api/vpn/my ---
+# =======================
+def _render_key(key: VPNKey, server_name: str) -> dict:
+    return {
+        "vpn_key_id": key.id,
+        "server_id": key.idServerVPN,
+        "serverName": server_name,
+        "access_data": key.access_data,
+        "expires_at": key.expires_at.isoformat(),
+        "is_active": key.is_active
+    }
+
+
+# пересобрать витрину одного пользователя внутри текущей транзакции
+async def _refresh_user_vpn_view(session, id_user: int, tg_id: int):
+    rows = await session.execute(
+        select(VPNKey, ServersVPN.nameVPN)
+        .join(ServersVPN, VPNKey.idServerVPN == ServersVPN.idServerVPN)
+        .where(VPNKey.idUser == id_user)
+        .order_by(VPNKey.id)
+    )
+    keys = [_render_key(key, name) for key, name in rows]
+
+    await session.merge(UserVPNView(
+        tg_id=tg_id,
+        idUser=id_user,
+        keys_json=json.dumps(keys, ensure_ascii=False),
+        updated_at=datetime.utcnow()
+    ))
+
+
+# пересобрать витрины всех пользователей, у которых есть ключи на серверах
+async def _refresh_user_vpn_views_for_servers(session, server_ids: List[int]):
+    users = await session.execute(
+        select(User.idUser, User.tg_id)
+        .join(VPNKey, VPNKey.idUser == User.idUser)
+        .where(VPNKey.idServerVPN.in_(server_ids))
+        .distinct()
+    )
+    for id_user, tg_id in users.all():
+        await _refresh_user_vpn_view(session, id_user, tg_id)
+
+
+# полная пересборка витрины (на случай рассинхронизации)
+async def rebuild_user_vpn_views():
+    async with async_session() as session:
+        users = {u.idUser: u.tg_id for u in await session.scalars(select(User))}
+
+        rows = await session.execute(
+            select(VPNKey, ServersVPN.nameVPN)
+            .join(ServersVPN, VPNKey.idServerVPN == ServersVPN.idServerVPN)
+            .order_by(VPNKey.idUser, VPNKey.id)
+        )
+        keys_by_user = {}
+        for key, name in rows:
+            keys_by_user.setdefault(key.idUser, []).append(_render_key(key, name))
+
+        await session.execute(delete(UserVPNView))
+        now = datetime.utcnow()
+        for id_user, tg_id in users.items():
+            session.add(UserVPNView(
+                tg_id=tg_id,
+                idUser=id_user,
+                keys_json=json.dumps(keys_by_user.get(id_user, []), ensure_ascii=False),
+                updated_at=now
+            ))
+        await session.commit()
+        return {"status": "ok", "users": len(users)}
+
+
+# первичное заполнение витрины после деплоя на существующую базу
+async def ensure_user_vpn_views():
+    async with async_session() as session:
+        has_views = await session.scalar(select(UserVPNView.tg_id).limit(1))
+        has_users = await session.scalar(select(User.idUser).limit(1))
+    if has_users is not None and has_views is None:
+        await rebuild_user_vpn_views()
+
+
+# =======================
+# --- tg_id -> idUser ---
+# =======================
+class UserIdCache:
+    """LRU-кэш соответствий tg_id -> idUser (пользователи не удаляются, поэтому без TTL)"""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[int, int] = OrderedDict()
+
+    def get(self, tg_id: int) -> int | None:
+        id_user = self._data.get(tg_id)
+        if id_user is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(tg_id)
+        self.hits += 1
+        return id_user
+
+    def put(self, tg_id: int, id_user: int):
+        self._data[tg_id] = id_user
+        self._data.move_to_end(tg_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+user_id_cache = UserIdCache()
+
+
+# единая точка получения idUser: кэш, иначе upsert без гонки на unique(tg_id)
+async def resolve_user_id(tg_id: int, user_role: str = "user") -> int:
+    id_user = user_id_cache.get(tg_id)
+    if id_user is not None:
+        return id_user
+
+    async with async_session() as session:
+        id_user = await session.scalar(
+            sqlite_insert(User)
+            .values(tg_id=tg_id, userRole=user_role)
+            .on_conflict_do_nothing(index_elements=[User.tg_id])
+            .returning(User.idUser)
+        )
+        if id_user is None:
+            # пользователь уже есть (или его только что создал параллельный запрос)
+            id_user = await session.scalar(select(User.idUser).where(User.tg_id == tg_id))
+        else:
+            await _increment(session, StatsDaily, {"day": datetime.utcnow().date()}, signups=1)
+        await session.commit()
+
+    user_id_cache.put(tg_id, id_user)
+    return id_user
+
+
+# то же без создания пользователя: для чтений, где неизвестный tg_id - это просто пустой результат
+async def lookup_user_id(tg_id: int) -> int | None:
+    id_user = user_id_cache.get(tg_id)
+    if id_user is not None:
+        return id_user
+
+    async with async_session() as session:
+        id_user = await session.scalar(select(User.idUser).where(User.tg_id == tg_id))
+    if id_user is not None:
+        user_id_cache.put(tg_id, id_user)
+    return id_user
+
+
+def get_user_cache_stats() -> dict:
+    return user_id_cache.stats()
+
+
+# =======================
+# --- SUBSCRIPTION URL ---
+# =======================
+# общий для всех воркеров и перезапусков, иначе выданные ссылки перестанут работать
+SUBSCRIPTION_SECRET = os.getenv("SUBSCRIPTION_SECRET")
+
+
+def sign_subscription(tg_id: int) -> str:
+    return hmac.new(SUBSCRIPTION_SECRET.encode(), str(tg_id).encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def check_subscription_signature(tg_id: int, sig: str) -> bool:
+    return hmac.compare_digest(sign_subscription(tg_id), sig)
+
+
+WEBAPP_INIT_DATA_TTL = 24 * 3600  # секунд, сколько действителен initData мини-приложения
+
+
+# проверка Telegram WebApp initData, возвращает tg_id пользователя или None
+def check_webapp_init_data(init_data: str, bot_token: str | None) -> int | None:
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", None)
+    if not received_hash or not bot_token:
+        return None
+
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    calculated = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(calculated, received_hash):
+        return None
+
+    try:
+        if time.time() - int(fields["auth_date"]) > WEBAPP_INIT_DATA_TTL:
+            return None
+        return int(json.loads(fields["user"])["id"])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+class SubscriptionCache:
+    """
+    LRU-кэш готовых тел подписки: tg_id -> {"version", "etag", "plain", "base64"}.
+    version = UserVPNView.updated_at, поэтому запись, изменённая любым воркером,
+    видна при следующем запросе
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[int, dict] = OrderedDict()
+
+    def get(self, tg_id: int, version: datetime | None) -> dict | None:
+        doc = self._data.get(tg_id)
+        if doc is None or doc["version"] != version:
+            self.misses += 1
+            return None
+        self._data.move_to_end(tg_id)
+        self.hits += 1
+        return doc
+
+    def put(self, tg_id: int, doc: dict):
+        self._data[tg_id] = doc
+        self._data.move_to_end(tg_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+subscription_cache = SubscriptionCache()
+
+
+def _render_subscription(keys: List[dict], version: datetime | None) -> dict:
+    plain = "\n".join(k["access_data"] for k in keys if k["is_active"])
+    return {
+        "version": version,
+        "etag": '"' + hashlib.sha256(plain.encode()).hexdigest()[:32] + '"',
+        "plain": plain,
+        "base64": base64.b64encode(plain.encode()).decode()
+    }
+
+
+# документ подписки со всеми активными ключами пользователя.
+# на каждый запрос - одно чтение updated_at по первичному ключу, тело пересобирается только при изменении
+async def get_subscription(tg_id: int) -> dict:
+    async with async_session() as session:
+        version = await session.scalar(select(UserVPNView.updated_at).where(UserVPNView.tg_id == tg_id))
+        doc = subscription_cache.get(tg_id, version)
+        if doc is not None:
+            return doc
+
+        view = await session.get(UserVPNView, tg_id)
+        if view:
+            doc = _render_subscription(json.loads(view.keys_json), view.updated_at)
+        else:
+            doc = _render_subscription([], None)
+
+    subscription_cache.put(tg_id, doc)
+    return doc
+
+
+def get_subscription_cache_stats() -> dict:
+    return subscription_cache.stats()
+
+
+# =======================
+# --- STATS ---
+# =======================
+RENEW_STARS_PER_MONTH = 50
+
+
+# атомарно прибавить значения к строке счётчиков (строка создаётся при первом обращении)
+async def _increment(session, model, key: dict, **deltas):
+    stmt = sqlite_insert(model).values(**key, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(key),
+        set_={c: getattr(model, c) + stmt.excluded[c] for c in deltas}
+    )
+    await session.execute(stmt)
+
+
+async def _stats_on_activation(session, server: ServersVPN):
+    await _increment(session, StatsServer, {"idServerVPN": server.idServerVPN},
+                     active_keys=1, activations=1, revenue=server.price)
+    await _increment(session, StatsCountry, {"idCountry": server.idCountry},
+                     active_keys=1, activations=1, revenue=server.price)
+    await _increment(session, StatsDaily, {"day": datetime.utcnow().date()}, activations=1, revenue=server.price)
+
+
+async def _stats_on_renewal(session, server: ServersVPN, amount: int, reactivated: bool):
+    active = 1 if reactivated else 0
+    await _increment(session, StatsServer, {"idServerVPN": server.idServerVPN}, active_keys=active, revenue=amount)
+    await _increment(session, StatsCountry, {"idCountry": server.idCountry}, active_keys=active, revenue=amount)
+    await _increment(session, StatsDaily, {"day": datetime.utcnow().date()}, renewals=1, revenue=amount)
+
+
+# первичное заполнение счётчиков после деплоя на существующую базу.
+# восстанавливаются только active_keys, activations и signups: выручка, продления
+# и истечения нигде кроме счётчиков не хранятся, история до деплоя останется нулевой
+async def ensure_stats():
+    async with async_session() as session:
+        has_servers = await session.scalar(select(StatsServer.idServerVPN).limit(1))
+        has_countries = await session.scalar(select(StatsCountry.idCountry).limit(1))
+        has_keys = (await session.scalar(select(VPNKey.id).limit(1)) is not None
+                    or await session.scalar(select(VPNKeyArchive.id).limit(1)) is not None)
+    if has_keys and (has_servers is None or has_countries is None):
+        await check_stats(fix=True)
+
+
+async def get_stats(days: int = 30) -> dict:
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+
+    async with async_session() as session:
+        servers = await session.scalars(select(StatsServer).order_by(StatsServer.idServerVPN))
+        countries = await session.scalars(select(StatsCountry).order_by(StatsCountry.idCountry))
+        daily = await session.scalars(select(StatsDaily).where(StatsDaily.day >= since).order_by(StatsDaily.day))
+        return {
+            "servers": [
+                {"idServerVPN": s.idServerVPN, "active_keys": s.active_keys,
+                 "activations": s.activations, "revenue": s.revenue} for s in servers
+            ],
+            "countries": [
+                {"idCountry": c.idCountry, "active_keys": c.active_keys,
+                 "activations": c.activations, "revenue": c.revenue} for c in countries
+            ],
+            "daily": [
+                {"day": d.day.isoformat(), "signups": d.signups, "activations": d.activations,
+                 "renewals": d.renewals, "expirations": d.expirations, "revenue": d.revenue} for d in daily
+            ]
+        }
+
+
+# сверка счётчиков с базовыми таблицами. Выручка, продления и истечения
+# нигде больше не хранятся, поэтому проверяются только active_keys, activations и signups.
+# activations и revenue по странам относятся к стране сервера на момент покупки
+# и при смене страны не переносятся, поэтому для стран сверяется только active_keys
+async def check_stats(fix: bool = False) -> dict:
+    async with async_session() as session:
+        all_keys = union_all(
+            select(VPNKey.idServerVPN.label("server_id"), VPNKey.created_at.label("created_at")),
+            select(VPNKeyArchive.idServerVPN, VPNKeyArchive.created_at)
+        ).subquery()
+
+        expected = {StatsServer: {}, StatsCountry: {}, StatsDaily: {}}
+
+        rows = await session.execute(
+            select(VPNKey.idServerVPN, func.count()).where(VPNKey.is_active == True).group_by(VPNKey.idServerVPN)
+        )
+        for server_id, n in rows:
+            expected[StatsServer].setdefault(server_id, {})["active_keys"] = n
+
+        rows = await session.execute(
+            select(all_keys.c.server_id, func.count()).group_by(all_keys.c.server_id)
+        )
+        for server_id, n in rows:
+            expected[StatsServer].setdefault(server_id, {})["activations"] = n
+
+        rows = await session.execute(
+            select(ServersVPN.idCountry, func.count())
+            .join(VPNKey, VPNKey.idServerVPN == ServersVPN.idServerVPN)
+            .where(VPNKey.is_active == True)
+            .group_by(ServersVPN.idCountry)
+        )
+        for country_id, n in rows:
+            expected[StatsCountry].setdefault(country_id, {})["active_keys"] = n
+
+        rows = await session.execute(
+            select(func.date(User.created_at), func.count()).group_by(func.date(User.created_at))
+        )
+        for day, n in rows:
+            if day:
+                expected[StatsDaily].setdefault(date.fromisoformat(day), {})["signups"] = n
+
+        rows = await session.execute(
+            select(func.date(all_keys.c.created_at), func.count()).group_by(func.date(all_keys.c.created_at))
+        )
+        for day, n in rows:
+            if day:
+                expected[StatsDaily].setdefault(date.fromisoformat(day), {})["activations"] = n
+
+        mismatches = []
+        for model, fields, pk in (
+            (StatsServer, ("active_keys", "activations"), "idServerVPN"),
+            (StatsCountry, ("active_keys",), "idCountry"),
+            (StatsDaily, ("signups", "activations"), "day"),
+        ):
+            stored = {getattr(r, pk): r for r in await session.scalars(select(model))}
+            for key in set(stored) | set(expected[model]):
+                want = expected[model].get(key, {})
+                row = stored.get(key)
+                for field in fields:
+                    actual = getattr(row, field) if row else 0
+                    if actual != want.get(field, 0):
+                        mismatches.append({
+                            "table": model.__tablename__,
+                            "key": key.isoformat() if isinstance(key, date) else key,
+                            "field": field,
+                            "stored": actual,
+                            "expected": want.get(field, 0)
+                        })
+                        if fix:
+                            await _increment(session, model, {pk: key}, **{field: want.get(field, 0) - actual})
+
+        if fix:
+            await session.commit()
+        return {"mismatches": mismatches, "fixed": fix}
 
 
 
@@ -22,21 +455,17 @@ async def get_server_by_id(server_id: int):
 # активация впн после оплаты
 async def activate_vpn_from_payload(payload: str):
     _, tg_id, server_id, _ = payload.split(":")
+    tg_id = int(tg_id)
+    id_user = await resolve_user_id(tg_id)
 
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == int(tg_id)))
-        if not user:
-            user = User(tg_id=int(tg_id))
-            session.add(user)
-            await session.commit()
-
         server = await session.get(ServersVPN, int(server_id))
         api = OutlineAPI(server.api_url)
 
         key_data = api.create_key("VPN User")
 
         vpn_key = VPNKey(
-            idUser=user.idUser,
+            idUser=id_user,
             idServerVPN=server.idServerVPN,
             provider="outline",
             provider_key_id=key_data["id"],
@@ -45,6 +474,16 @@ async def activate_vpn_from_payload(payload: str):
         )
 
         session.add(vpn_key)
+        await session.flush()
+
+        session.add(VPNSubscription(
+            idUser=id_user,
+            vpn_key_id=vpn_key.id,
+            expires_at=vpn_key.expires_at
+        ))
+
+        await _stats_on_activation(session, server)
+        await _refresh_user_vpn_view(session, id_user, tg_id)
         await session.commit()
 
 
@@ -53,24 +492,237 @@ async def renew_vpn_from_payload(payload: str):
 
     async with async_session() as session:
         key = await session.get(VPNKey, int(key_id))
-        key.expires_at += timedelta(days=30 * int(months))
+        if not key:
+            # счёт мог быть оплачен уже после архивации ключа
+            key = await _restore_archived_key(session, int(key_id))
+        if not key:
+            raise ValueError(f"VPN ключ с id {key_id} не найден")
+        reactivated = not key.is_active
+        key.expires_at = max(key.expires_at, datetime.utcnow()) + timedelta(days=30 * int(months))
+        key.is_active = True
+
+        server = await session.get(ServersVPN, key.idServerVPN)
+        await _stats_on_renewal(session, server, RENEW_STARS_PER_MONTH * int(months), reactivated)
+
+        renewed = await session.execute(
+            update(VPNSubscription)
+            .where(VPNSubscription.vpn_key_id == key.id)
+            .values(expires_at=key.expires_at, status="active")
+        )
+        if not renewed.rowcount:
+            session.add(VPNSubscription(idUser=key.idUser, vpn_key_id=key.id, expires_at=key.expires_at))
+
+        user = await session.get(User, key.idUser)
+        await _refresh_user_vpn_view(session, user.idUser, user.tg_id)
+        await session.commit()
+
+
+# истечение ключей: помечаем просроченные и обновляем витрины владельцев
+async def expire_vpn_keys():
+    now = datetime.utcnow()
+
+    async with async_session() as session:
+        # условие повторяется в самом UPDATE: ключ, продлённый параллельно,
+        # не будет выключен, а второй воркер не посчитает истечение дважды
+        expired = (await session.execute(
+            update(VPNKey)
+            .where(VPNKey.is_active == True, VPNKey.expires_at <= now)
+            .values(is_active=False)
+            .returning(VPNKey.id, VPNKey.idUser, VPNKey.idServerVPN)
+            .execution_options(synchronize_session=False)
+        )).all()
+        if not expired:
+            await session.commit()
+            return {"expired": 0}
+
+        key_ids = [key_id for key_id, _, _ in expired]
+        await session.execute(
+            update(VPNSubscription)
+            .where(VPNSubscription.vpn_key_id.in_(key_ids), VPNSubscription.status == "active")
+            .values(status="expired")
+        )
+
+        per_server = {}
+        for _, _, server_id in expired:
+            per_server[server_id] = per_server.get(server_id, 0) + 1
+        servers = await session.execute(
+            select(ServersVPN.idServerVPN, ServersVPN.idCountry).where(ServersVPN.idServerVPN.in_(per_server))
+        )
+        for server_id, country_id in servers.all():
+            await _increment(session, StatsServer, {"idServerVPN": server_id}, active_keys=-per_server[server_id])
+            await _increment(session, StatsCountry, {"idCountry": country_id}, active_keys=-per_server[server_id])
+        await _increment(session, StatsDaily, {"day": datetime.utcnow().date()}, expirations=len(key_ids))
+
+        users = await session.execute(
+            select(User.idUser, User.tg_id).where(User.idUser.in_({id_user for _, id_user, _ in expired}))
+        )
+        for id_user, tg_id in users.all():
+            await _refresh_user_vpn_view(session, id_user, tg_id)
+
         await session.commit()
+        return {"expired": len(key_ids)}
+
+
+
+
+# =======================
+# --- ARCHIVE ---
+# =======================
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "90"))
+ARCHIVE_CHUNK_SIZE = 500
+
+# колонки горячей таблицы -> колонки архива
+_KEY_COLUMNS = {"id": "vpn_key_id", "idUser": "idUser", "idServerVPN": "idServerVPN",
+                "provider": "provider", "provider_key_id": "provider_key_id", "access_data": "access_data",
+                "created_at": "created_at", "expires_at": "expires_at", "is_active": "is_active"}
+_SUBSCRIPTION_COLUMNS = {"id": "subscription_id", "idUser": "idUser", "vpn_key_id": "vpn_key_id",
+                         "started_at": "started_at", "expires_at": "expires_at", "status": "status"}
+
+
+# переносит ключи и их подписки в архив внутри текущей транзакции, возвращает число подписок
+async def _archive_keys(session, key_ids: List[int]) -> int:
+    now = datetime.utcnow()
+    await session.execute(
+        insert(VPNKeyArchive).from_select(
+            list(_KEY_COLUMNS.values()) + ["archived_at"],
+            select(*[getattr(VPNKey, c) for c in _KEY_COLUMNS], literal(now))
+            .where(VPNKey.id.in_(key_ids))
+        )
+    )
+    subs = await session.execute(
+        insert(VPNSubscriptionArchive).from_select(
+            list(_SUBSCRIPTION_COLUMNS.values()) + ["archived_at"],
+            select(*[getattr(VPNSubscription, c) for c in _SUBSCRIPTION_COLUMNS], literal(now))
+            .where(VPNSubscription.vpn_key_id.in_(key_ids))
+        )
+    )
+
+    users = (await session.execute(
+        select(User.idUser, User.tg_id)
+        .join(VPNKey, VPNKey.idUser == User.idUser)
+        .where(VPNKey.id.in_(key_ids))
+        .distinct()
+    )).all()
+
+    await session.execute(delete(VPNSubscription).where(VPNSubscription.vpn_key_id.in_(key_ids)))
+    await session.execute(delete(VPNKey).where(VPNKey.id.in_(key_ids)))
 
+    for id_user, tg_id in users:
+        await _refresh_user_vpn_view(session, id_user, tg_id)
 
+    return subs.rowcount
+
+
+# переносит неактивные ключи, истёкшие раньше срока хранения, вместе с их подписками.
+# каждая пачка - отдельная короткая транзакция, чтобы не держать блокировку записи SQLite
+async def archive_expired_keys(retention_days: int = ARCHIVE_RETENTION_DAYS,
+                               chunk_size: int = ARCHIVE_CHUNK_SIZE) -> dict:
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    moved_keys = 0
+    moved_subscriptions = 0
+
+    while True:
+        async with async_session() as session:
+            key_ids = (await session.scalars(
+                select(VPNKey.id)
+                .where(VPNKey.is_active == False, VPNKey.expires_at < cutoff)
+                .order_by(VPNKey.id)
+                .limit(chunk_size)
+            )).all()
+            if not key_ids:
+                break
+
+            subs = await _archive_keys(session, key_ids)
+            await session.commit()
+
+        moved_keys += len(key_ids)
+        moved_subscriptions += subs
+
+    return {"keys": moved_keys, "subscriptions": moved_subscriptions, "cutoff": cutoff.isoformat()}
+
+
+# вернуть ключ из архива в vpn_keys (неактивным) под тем же id.
+# архивные подписки остаются историей; None, если ключа нет или его сервер удалён
+async def _restore_archived_key(session, key_id: int) -> VPNKey | None:
+    archived = await session.scalar(
+        select(VPNKeyArchive)
+        .where(VPNKeyArchive.vpn_key_id == key_id)
+        .order_by(VPNKeyArchive.id.desc())
+        .limit(1)
+    )
+    if not archived or not await session.get(ServersVPN, archived.idServerVPN):
+        return None
+
+    key = VPNKey(
+        id=key_id,
+        idUser=archived.idUser,
+        idServerVPN=archived.idServerVPN,
+        provider=archived.provider,
+        provider_key_id=archived.provider_key_id,
+        access_data=archived.access_data,
+        created_at=archived.created_at,
+        expires_at=archived.expires_at,
+        is_active=False
+    )
+    session.add(key)
+    # ключ не должен считаться и в архиве, и в vpn_keys (check_stats)
+    await session.delete(archived)
+    await session.flush()
+    return key
+
+
+async def admin_get_archived_keys(tg_id: int | None = None, limit: int = 100, offset: int = 0) -> List[dict]:
+    query = select(VPNKeyArchive).order_by(VPNKeyArchive.id.desc()).limit(limit).offset(offset)
+    if tg_id is not None:
+        id_user = await lookup_user_id(tg_id)
+        if id_user is None:
+            return []
+        query = query.where(VPNKeyArchive.idUser == id_user)
+
+    async with async_session() as session:
+        keys = await session.scalars(query)
+        return [
+            {
+                "vpn_key_id": k.vpn_key_id,
+                "idUser": k.idUser,
+                "server_id": k.idServerVPN,
+                "provider": k.provider,
+                "provider_key_id": k.provider_key_id,
+                "created_at": k.created_at.isoformat(),
+                "expires_at": k.expires_at.isoformat(),
+                "archived_at": k.archived_at.isoformat()
+            } for k in keys
+        ]
+
+
+async def admin_get_archived_subscriptions(tg_id: int | None = None, limit: int = 100, offset: int = 0) -> List[dict]:
+    query = select(VPNSubscriptionArchive).order_by(VPNSubscriptionArchive.id.desc()).limit(limit).offset(offset)
+    if tg_id is not None:
+        id_user = await lookup_user_id(tg_id)
+        if id_user is None:
+            return []
+        query = query.where(VPNSubscriptionArchive.idUser == id_user)
+
+    async with async_session() as session:
+        subs = await session.scalars(query)
+        return [
+            {
+                "id": s.subscription_id,
+                "idUser": s.idUser,
+                "vpn_key_id": s.vpn_key_id,
+                "started_at": s.started_at.isoformat(),
+                "expires_at": s.expires_at.isoformat(),
+                "status": s.status,
+                "archived_at": s.archived_at.isoformat()
+            } for s in subs
+        ]
 
 
 # --- Пользователи ---
 async def add_user(tg_id: int, user_role: str):
+    id_user = await resolve_user_id(tg_id, user_role)
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
-        if user:
-            return user
-
-        new_user = User(tg_id=tg_id, userRole=user_role)
-        session.add(new_user)
-        await session.commit()
-        await session.refresh(new_user)
-        return new_user
+        return await session.get(User, id_user)
 
 
 # --- Серверы VPN ---
@@ -91,29 +743,13 @@ async def get_servers() -> List[dict]:
 
 
 # --- Список VPN пользователя ---
+# читается из витрины UserVPNView одним запросом по первичному ключу
 async def get_my_vpns(tg_id: int) -> List[dict]:
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
-        if not user:
+        view = await session.get(UserVPNView, tg_id)
+        if not view:
             return []
-
-        subscriptions = await session.scalars(
-            select(VPNSubscription, VPNKey)
-            .join(VPNKey, VPNSubscription.vpn_key_id == VPNKey.id)
-            .where(VPNSubscription.idUser == user.idUser)
-        )
-
-        result = []
-        for sub, key in subscriptions:
-            result.append({
-                "vpn_key_id": key.id,
-                "server_id": key.idServerVPN,
-                "serverName": (await session.get(ServersVPN, key.idServerVPN)).nameVPN,
-                "access_data": key.access_data,
-                "expires_at": key.expires_at.isoformat(),
-                "is_active": key.is_active
-            })
-        return result
+        return json.loads(view.keys_json)
     
     
 # =======================
@@ -260,6 +896,131 @@ async def admin_add_server(server):
         await session.refresh(s)
         return {"idServerVPN": s.idServerVPN, "nameVPN": s.nameVPN}
 
+# синхронизация витрин и счётчиков после изменения сервера
+async def _on_server_changed(session, server_id: int, old_name: str, old_country: int, server):
+    # активные ключи сервера переезжают в счётчики новой страны
+    if old_country != server.idCountry:
+        active = await session.scalar(
+            select(func.count()).select_from(VPNKey)
+            .where(VPNKey.idServerVPN == server_id, VPNKey.is_active == True)
+        )
+        if active:
+            await _increment(session, StatsCountry, {"idCountry": old_country}, active_keys=-active)
+            await _increment(session, StatsCountry, {"idCountry": server.idCountry}, active_keys=active)
+
+    # имя сервера хранится в витринах пользователей
+    if old_name != server.nameVPN:
+        await _refresh_user_vpn_views_for_servers(session, [server_id])
+
+
+PROBE_TIMEOUT = 5  # секунд на проверку одного сервера
+PROBE_CONCURRENCY = 50
+
+
+# проверка доступности Outline API нового сервера
+async def _probe_server(http: aiohttp.ClientSession, semaphore: asyncio.Semaphore, api_url: str) -> str | None:
+    async with semaphore:
+        try:
+            async with http.get(f"{api_url.rstrip('/')}/server") as response:
+                response.raise_for_status()
+            return None
+        except asyncio.TimeoutError:
+            return f"нет ответа за {PROBE_TIMEOUT} с"
+        except Exception as e:
+            return str(e) or type(e).__name__
+
+
+# массовый импорт: upsert по server_ip, одна транзакция, результат по каждой строке
+async def admin_bulk_upsert_servers(servers: list) -> List[dict]:
+    results = [{"index": i, "server_ip": s.server_ip} for i, s in enumerate(servers)]
+
+    async with async_session() as session:
+        type_ids = set(await session.scalars(
+            select(TypesVPN.idTypeVPN).where(TypesVPN.idTypeVPN.in_({s.idTypeVPN for s in servers}))
+        ))
+        country_ids = set(await session.scalars(
+            select(CountriesVPN.idCountry).where(CountriesVPN.idCountry.in_({s.idCountry for s in servers}))
+        ))
+        existing = {}
+        for s in await session.scalars(
+            select(ServersVPN)
+            .where(ServersVPN.server_ip.in_({s.server_ip for s in servers}))
+            .order_by(ServersVPN.idServerVPN)
+        ):
+            existing.setdefault(s.server_ip, s)
+        # сессию не держим открытой во время проверки серверов по сети
+
+    valid = []
+    seen_ips = set()
+    for res, server in zip(results, servers):
+        if server.server_ip in seen_ips:
+            res.update(status="error", error=f"server_ip {server.server_ip} повторяется в запросе")
+        elif server.idTypeVPN not in type_ids:
+            res.update(status="error", error=f"TypeVPN с id {server.idTypeVPN} не найден")
+        elif server.idCountry not in country_ids:
+            res.update(status="error", error=f"CountryVPN с id {server.idCountry} не найден")
+        else:
+            valid.append((res, server))
+        seen_ips.add(server.server_ip)
+
+    new_rows = [(res, server) for res, server in valid if server.server_ip not in existing]
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as http:
+        probe_errors = await asyncio.gather(*[_probe_server(http, semaphore, server.api_url) for _, server in new_rows])
+    probe_by_index = {res["index"]: err for (res, _), err in zip(new_rows, probe_errors)}
+
+    async with async_session() as session:
+        # UPDATE без строк открывает пишущую транзакцию SQLite, поэтому параллельный
+        # импорт ждёт, и повторная проверка server_ip ниже не устареет до коммита
+        await session.execute(
+            update(ServersVPN).where(false()).values(is_active=ServersVPN.is_active)
+            .execution_options(synchronize_session=False)
+        )
+
+        existing = {}
+        for s in await session.scalars(
+            select(ServersVPN)
+            .where(ServersVPN.server_ip.in_({server.server_ip for _, server in valid}))
+            .order_by(ServersVPN.idServerVPN)
+        ):
+            existing.setdefault(s.server_ip, s)
+
+        for res, server in valid:
+            values = dict(
+                nameVPN=server.nameVPN,
+                price=server.price,
+                max_conn=server.max_conn,
+                server_ip=server.server_ip,
+                api_url=server.api_url,
+                api_token=server.api_token,
+                idTypeVPN=server.idTypeVPN,
+                idCountry=server.idCountry,
+                is_active=server.is_active
+            )
+            old = existing.get(server.server_ip)
+            if old:
+                await session.execute(
+                    update(ServersVPN).where(ServersVPN.idServerVPN == old.idServerVPN).values(**values)
+                )
+                await _on_server_changed(session, old.idServerVPN, old.nameVPN, old.idCountry, server)
+                res.update(status="updated", idServerVPN=old.idServerVPN, is_active=server.is_active)
+            elif res["index"] not in probe_by_index:
+                res.update(status="error", error=f"сервер {server.server_ip} удалён во время импорта")
+            else:
+                # новый сервер включается, только если его API ответил
+                probe_error = probe_by_index[res["index"]]
+                if probe_error:
+                    values["is_active"] = False
+                    res["probe_error"] = probe_error
+                s = ServersVPN(**values)
+                session.add(s)
+                await session.flush()
+                res.update(status="created", idServerVPN=s.idServerVPN, is_active=s.is_active)
+
+        await session.commit()
+
+    return results
+
 async def admin_update_server(server_id: int, server):
     async with async_session() as session:
         # проверка существования сервера
@@ -277,6 +1038,8 @@ async def admin_update_server(server_id: int, server):
         if not country_obj:
             raise ValueError(f"CountryVPN с id {server.idCountry} не найден")
 
+        old_name, old_country = existing.nameVPN, existing.idCountry
+
         await session.execute(update(ServersVPN).where(ServersVPN.idServerVPN == server_id).values(
             nameVPN=server.nameVPN,
             price=server.price,
@@ -288,11 +1051,146 @@ async def admin_update_server(server_id: int, server):
             idCountry=server.idCountry,
             is_active=server.is_active
         ))
+
+        await _on_server_changed(session, server_id, old_name, old_country, server)
         await session.commit()
         return {"status": "ok"}
 
 async def admin_delete_server(server_id: int):
     async with async_session() as session:
+        existing = await session.get(ServersVPN, server_id)
+        if existing:
+            active = await session.scalar(
+                select(func.count()).select_from(VPNKey)
+                .where(VPNKey.idServerVPN == server_id, VPNKey.is_active == True)
+            )
+            # строка StatsServer остаётся: activations и revenue удалённого сервера
+            # по-прежнему учитываются в истории (его ключи лежат в архиве)
+            if active:
+                await _increment(session, StatsServer, {"idServerVPN": server_id}, active_keys=-active)
+                await _increment(session, StatsCountry, {"idCountry": existing.idCountry}, active_keys=-active)
+
+        # ключи удаляемого сервера отзываются и уходят в архив, история сохраняется
+        key_ids = (await session.scalars(select(VPNKey.id).where(VPNKey.idServerVPN == server_id))).all()
+        if key_ids:
+            await session.execute(update(VPNKey).where(VPNKey.id.in_(key_ids)).values(is_active=False))
+            await session.execute(
+                update(VPNSubscription)
+                .where(VPNSubscription.vpn_key_id.in_(key_ids), VPNSubscription.status == "active")
+                .values(status="revoked")
+            )
+            await _archive_keys(session, key_ids)
+
         await session.execute(delete(ServersVPN).where(ServersVPN.idServerVPN == server_id))
         await session.commit()
         return {"status": "ok"}
+
+
+# =======================
+# --- EXPORTS ---
+# =======================
+EXPORT_FORMATS = ("csv", "ndjson")
+EXPORT_BATCH_SIZE = 500
+
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+# строки читаются курсором через AsyncSession.stream и кодируются пачками,
+# поэтому память не зависит от размера таблицы
+async def _stream_export(query, fmt: str) -> AsyncIterator[str]:
+    async with async_session() as session:
+        result = await session.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        columns = list(result.keys())
+
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if fmt == "csv":
+            writer.writerow(columns)
+
+        rows = 0
+        async for row in result:
+            values = [_export_value(v) for v in row]
+            if fmt == "csv":
+                writer.writerow(values)
+            else:
+                buf.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False) + "\n")
+
+            rows += 1
+            if rows % EXPORT_BATCH_SIZE == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+
+        if buf.tell():
+            yield buf.getvalue()
+
+
+def _date_range(query, column, date_from: datetime | None, date_to: datetime | None):
+    if date_from:
+        query = query.where(column >= date_from)
+    if date_to:
+        query = query.where(column < date_to)
+    return query
+
+
+# архивные ключи тоже попадают в выгрузку (колонка archived), иначе отчёт
+# за давний период молча терял бы ключи старше ARCHIVE_RETENTION_DAYS
+def export_keys(fmt: str, date_from: datetime | None = None, date_to: datetime | None = None) -> AsyncIterator[str]:
+    hot = select(
+        VPNKey.id.label("id"), VPNKey.idUser, VPNKey.idServerVPN, VPNKey.provider, VPNKey.provider_key_id,
+        VPNKey.created_at, VPNKey.expires_at, VPNKey.is_active, literal(False).label("archived")
+    )
+    cold = select(
+        VPNKeyArchive.vpn_key_id, VPNKeyArchive.idUser, VPNKeyArchive.idServerVPN, VPNKeyArchive.provider,
+        VPNKeyArchive.provider_key_id, VPNKeyArchive.created_at, VPNKeyArchive.expires_at,
+        VPNKeyArchive.is_active, literal(True)
+    )
+    keys = union_all(
+        _date_range(hot, VPNKey.created_at, date_from, date_to),
+        _date_range(cold, VPNKeyArchive.created_at, date_from, date_to)
+    ).subquery()
+
+    # сервер архивного ключа мог быть удалён, поэтому outer join
+    query = (
+        select(
+            keys.c.id, User.tg_id, keys.c.idUser, keys.c.idServerVPN, ServersVPN.nameVPN,
+            keys.c.provider, keys.c.provider_key_id, keys.c.created_at, keys.c.expires_at,
+            keys.c.is_active, keys.c.archived
+        )
+        .outerjoin(User, keys.c.idUser == User.idUser)
+        .outerjoin(ServersVPN, keys.c.idServerVPN == ServersVPN.idServerVPN)
+        .order_by(keys.c.created_at, keys.c.id)
+    )
+    return _stream_export(query, fmt)
+
+
+def export_users(fmt: str, date_from: datetime | None = None, date_to: datetime | None = None) -> AsyncIterator[str]:
+    query = select(
+        User.idUser, User.tg_id, User.userRole, User.trial_until, User.referrer_id, User.created_at
+    ).order_by(User.idUser)
+    return _stream_export(_date_range(query, User.created_at, date_from, date_to), fmt)
+
+
+# у серверов нет даты создания, фильтр по датам не применяется
+def export_servers(fmt: str) -> AsyncIterator[str]:
+    query = (
+        select(
+            ServersVPN.idServerVPN, ServersVPN.nameVPN, ServersVPN.price, ServersVPN.max_conn,
+            ServersVPN.now_conn, ServersVPN.server_ip, ServersVPN.api_url, ServersVPN.is_active,
+            ServersVPN.idTypeVPN, TypesVPN.nameType, ServersVPN.idCountry, CountriesVPN.nameCountry
+        )
+        .outerjoin(TypesVPN, ServersVPN.idTypeVPN == TypesVPN.idTypeVPN)
+        .outerjoin(CountriesVPN, ServersVPN.idCountry == CountriesVPN.idCountry)
+        .order_by(ServersVPN.idServerVPN)
+    )
+    return _stream_export(query, fmt)
+
+
+def export_referral_earnings(fmt: str, date_from: datetime | None = None, date_to: datetime | None = None) -> AsyncIterator[str]:
+    query = select(
+        ReferralEarning.id, ReferralEarning.referrer_id, ReferralEarning.referred_id,
+        ReferralEarning.amount, ReferralEarning.created_at
+    ).order_by(ReferralEarning.id)
+    return _stream_export(_date_range(query, ReferralEarning.created_at, date_from, date_to), fmt)